@@ -1,25 +1,89 @@
+from __future__ import annotations
+
+import time
+_T0 = time.perf_counter()   # отсчёт для бюджета времени старта
+
 import os
+import sys
 import json
 import random
 import subprocess
 import asyncio
+import argparse
 import base64
+import math
+import socket
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import uuid
+from fractions import Fraction
+import importlib.util
+from functools import wraps
+from contextlib import asynccontextmanager, closing
 from pathlib import Path
 from datetime import datetime, timedelta
-
-import requests
-import time
+from typing import TYPE_CHECKING
 import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ConversationHandler,
-    ContextTypes,
-    filters,
-)
+
+# telegram и requests тяжёлые — импортируются лениво (build_app, http_session),
+# чтобы модуль быстро грузился в воркерах и тестах
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
+
+# === Config ===
+# значения по умолчанию; перекрываются JSON-файлом (путь в UNIK_CONFIG)
+# и затем переменными окружения с тем же именем. Секретов в коде нет: без
+# BOT_TOKEN бот не стартует, без ключей FusionBrain не работает генерация
+DEFAULT_CONFIG = {
+    "BOT_TOKEN":              "",
+    "ADMIN_ID":               7552313011,
+    "FUSIONBRAIN_URL":        "https://api-key.fusionbrain.ai/",
+    "FUSIONBRAIN_API_KEY":    "",
+    "FUSIONBRAIN_SECRET_KEY": "",
+    "FFMPEG_BIN":             "ffmpeg/bin/ffmpeg.exe",
+    "BOT_MODE":               "polling",
+    "WEBHOOK_LISTEN":         "0.0.0.0",
+    "WEBHOOK_PORT":           8443,
+    "WEBHOOK_PATH":           "tg-webhook",
+    "WEBHOOK_URL":            "",
+    "WEBHOOK_SECRET":         "",
+    "RENDER_MODE":            "local",
+    "SETTINGS_DIR":           "bot_settings",   # в режиме broker — общий каталог бота и воркеров
+    "COMPOSITOR":             "auto",   # auto | ffmpeg | numpy
+    "STARTUP_BUDGET_SEC":     1.5,
+}
+
+def load_config() -> dict:
+    cfg  = dict(DEFAULT_CONFIG)
+    path = Path(os.environ.get("UNIK_CONFIG", "config.json"))
+    if path.exists():
+        cfg.update(json.loads(path.read_text()))
+    for key, default in DEFAULT_CONFIG.items():
+        if key in os.environ:
+            cfg[key] = type(default)(os.environ[key])
+    return cfg
+
+CONFIG = load_config()
+
+REQUIRED_SECRETS   = ("BOT_TOKEN",)   # генерация картинок — опция, её ключи проверяет fusion_brain()
+FUSIONBRAIN_SECRETS = ("FUSIONBRAIN_API_KEY", "FUSIONBRAIN_SECRET_KEY")
+
+def missing_secrets() -> list:
+    return [key for key in REQUIRED_SECRETS if not CONFIG[key]]
+
+# === HTTP ===
+_http = None
+
+def http_session():
+    # одна Session на процесс: keep-alive к FusionBrain и загрузкам по ссылке
+    global _http
+    if _http is None:
+        import requests
+        _http = requests.Session()
+    return _http
 
 class FusionBrainAPI:
     def __init__(self, url, api_key, secret_key):
@@ -29,12 +93,15 @@ class FusionBrainAPI:
             'X-Key':    f'Key {api_key}',
             'X-Secret': f'Secret {secret_key}',
         }
+        self.pipeline_id = None
 
     def get_pipeline(self):
         # полный путь: https://api-key.fusionbrain.ai/key/api/v1/pipelines
-        resp = requests.get(self.URL + 'key/api/v1/pipelines', headers=self.AUTH_HEADERS)
-        resp.raise_for_status()
-        return resp.json()[0]['id']
+        if self.pipeline_id is None:
+            resp = http_session().get(self.URL + 'key/api/v1/pipelines', headers=self.AUTH_HEADERS)
+            resp.raise_for_status()
+            self.pipeline_id = resp.json()[0]['id']
+        return self.pipeline_id
 
     def generate(self, prompt, pipeline_id, images=1, width=512, height=512):
         params = {
@@ -49,10 +116,10 @@ class FusionBrainAPI:
             "params":      (None, json.dumps(params), "application/json"),
         }
         url = self.URL + "key/api/v1/pipeline/run"
-        resp = requests.post(url, headers=self.AUTH_HEADERS, files=files)
+        resp = http_session().post(url, headers=self.AUTH_HEADERS, files=files)
         try:
             resp.raise_for_status()
-        except requests.exceptions.HTTPError as e:
+        except Exception:
             # Вот здесь мы распечатаем тело ответа от сервера FusionBrain
             print("FusionBrain generate() failed:")
             print("  URL:", url)
@@ -63,7 +130,7 @@ class FusionBrainAPI:
 
     def check_generation(self, uuid, attempts=20, delay=3):
         for _ in range(attempts):
-            resp = requests.get(
+            resp = http_session().get(
                 self.URL + f'key/api/v1/pipeline/status/{uuid}',
                 headers=self.AUTH_HEADERS
             )
@@ -74,29 +141,70 @@ class FusionBrainAPI:
             time.sleep(delay)
         return []
 
+_fusion_brain = None
+
+def fusion_brain() -> FusionBrainAPI:
+    # клиент и id пайплайна живут весь процесс, а не создаются на каждую генерацию
+    global _fusion_brain
+    if _fusion_brain is None:
+        missing = [key for key in FUSIONBRAIN_SECRETS if not CONFIG[key]]
+        if missing:
+            raise RuntimeError(f"генерация недоступна: не заданы {', '.join(missing)}")
+        _fusion_brain = FusionBrainAPI(
+            url=CONFIG["FUSIONBRAIN_URL"],
+            api_key=CONFIG["FUSIONBRAIN_API_KEY"],
+            secret_key=CONFIG["FUSIONBRAIN_SECRET_KEY"],
+        )
+    return _fusion_brain
+
 # === Bot Config ===
-BOT_TOKEN     = "7627856208:AAHF8ZwhuowoJxGUO-1mYeqjhSEWfvMDUDE"
-ADMIN_ID      = 7552313011
+BOT_TOKEN     = CONFIG["BOT_TOKEN"]
+ADMIN_ID      = CONFIG["ADMIN_ID"]
+
+def write_atomic(path: Path, text):
+    # пишем во временный файл рядом и подменяем: другие процессы (реплики,
+    # воркеры) никогда не читают недописанный файл; text — str или bytes
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(text, bytes) else 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
 
 APPROVED_FILE = Path("approved_users.json")
-if not APPROVED_FILE.exists():
-    APPROVED_FILE.write_text("[]")
 def load_approved() -> set:
+    if not APPROVED_FILE.exists():
+        return set()
     return set(json.loads(APPROVED_FILE.read_text()))
 def save_approved(s: set):
-    APPROVED_FILE.write_text(json.dumps(list(s)))
+    write_atomic(APPROVED_FILE, json.dumps(list(s)))
+
+# === Deployment ===
+# polling — один процесс; webhook — несколько реплик за балансировщиком,
+# общее состояние (настройки, шаг диалога) лежит в SETTINGS_DIR
+BOT_MODE       = CONFIG["BOT_MODE"]
+WEBHOOK_LISTEN = CONFIG["WEBHOOK_LISTEN"]
+WEBHOOK_PORT   = CONFIG["WEBHOOK_PORT"]
+WEBHOOK_PATH   = CONFIG["WEBHOOK_PATH"]
+WEBHOOK_URL    = CONFIG["WEBHOOK_URL"]     # публичный адрес балансировщика
+WEBHOOK_SECRET = CONFIG["WEBHOOK_SECRET"]  # X-Telegram-Bot-Api-Secret-Token
 
 # === Paths & Constants ===
-SETTINGS_DIR  = Path("bot_settings")
+SETTINGS_DIR  = Path(CONFIG["SETTINGS_DIR"])
 STATS_FILE    = Path("bot_stats.json")
-FFMPEG_BIN    = Path("ffmpeg/bin/ffmpeg.exe")
-FFPROBE_BIN   = FFMPEG_BIN.parent / "ffprobe.exe"
+FFMPEG_BIN    = Path(CONFIG["FFMPEG_BIN"])
+FFPROBE_BIN   = FFMPEG_BIN.parent / FFMPEG_BIN.name.replace("ffmpeg", "ffprobe")
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20 MB
 
-# Ensure persistence
-SETTINGS_DIR.mkdir(exist_ok=True)
-if not STATS_FILE.exists():
-    STATS_FILE.write_text(json.dumps({}))
+def ensure_storage():
+    # вызывается при старте бота/воркера, а не при импорте модуля
+    SETTINGS_DIR.mkdir(parents=True, exist_ok=True)
+    if not APPROVED_FILE.exists():
+        APPROVED_FILE.write_text("[]")
+    if not STATS_FILE.exists():
+        STATS_FILE.write_text(json.dumps({}))
 
 # === Conversation States ===
 (
@@ -108,13 +216,16 @@ if not STATS_FILE.exists():
     OFFSET_X_INPUT,
     OFFSET_Y_INPUT
 ) = range(7)
+END = -1  # ConversationHandler.END, без импорта telegram.ext
 
 # === Stats Helpers ===
 def load_stats() -> dict:
+    if not STATS_FILE.exists():
+        return {}
     return json.loads(STATS_FILE.read_text())
 
 def save_stats(stats: dict):
-    STATS_FILE.write_text(json.dumps(stats, indent=2))
+    write_atomic(STATS_FILE, json.dumps(stats, indent=2))
 
 async def approve_user(chat_id: int):
     stats = load_stats()
@@ -148,6 +259,10 @@ async def load_chat_settings(chat_id: int) -> dict:
         "n": 1,
         "animate": False,
         "use_img_gen": False,
+        "quality": "full",      # full | draft — быстрый черновик в низком разрешении
+        "renditions": [],       # короткие стороны рендиций, см. RENDITION_PRESETS
+        "img_prompt": None,
+        "awaiting": None,   # шаг диалога, которого ждём от пользователя
     }
     if path.exists():
         data = json.loads(path.read_text())
@@ -157,13 +272,823 @@ async def load_chat_settings(chat_id: int) -> dict:
     return defaults
 
 async def save_chat_settings(chat_id: int, settings: dict):
-    (SETTINGS_DIR / f"{chat_id}.json").write_text(
+    write_atomic(
+        SETTINGS_DIR / f"{chat_id}.json",
         json.dumps(settings, ensure_ascii=False, indent=2)
     )
 
+# === Rate Limiting & Admission ===
+# лимиты на пользователя и класс действия: (ёмкость, токенов в секунду)
+RATE_LIMITS = {
+    'render':  (2, 1 / 60),   # 🚀 Старт: 2 подряд, дальше раз в минуту
+    'preview': (5, 1 / 10),   # 🔍 Предпросмотр
+    'img_gen': (3, 1 / 30),   # 🎨 FusionBrain
+}
+HEAVY_ACTIONS      = {'render', 'preview'}   # те, что запускают ffmpeg
+MAX_ACTIVE_RENDERS = 2                       # одновременных ffmpeg в процессе
+MAX_QUEUE_DEPTH    = 8                       # сколько задач может ждать слот
+MAX_LOAD_AVG       = (os.cpu_count() or 1) * 1.5
+MAX_BROKER_QUEUE   = 50                      # в режиме broker: задач в очереди воркеров
+INFLIGHT_TTL_SEC   = 60                      # метка «выполняется» без heartbeat'а — процесс умер
+INFLIGHT_BEAT_SEC  = 15                      # как часто живой процесс продлевает свои метки
+# ведра токенов и метки «выполняется» общие для всех реплик и воркеров,
+# иначе лимиты умножаются на число процессов, а двойной тап уходит в две реплики
+LIMITS_DB          = SETTINGS_DIR / "limits.db"
+
+_heavy_jobs     = 0   # выполняются + ждут слот (локально: это CPU процесса)
+_render_slots   = asyncio.Semaphore(MAX_ACTIVE_RENDERS)
+
+def limits_db() -> sqlite3.Connection:
+    db = sqlite3.connect(LIMITS_DB, timeout=30, isolation_level=None)
+    db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+    # since — время последнего heartbeat'а, а не начала задачи
+    db.execute("CREATE TABLE IF NOT EXISTS inflight (key TEXT PRIMARY KEY, since REAL NOT NULL)")
+    return db
+
+def claim_action(chat_id: int, action: str) -> tuple:
+    # атомарно: ('busy', 0) — уже выполняется; ('limited', секунд ждать);
+    # ('ok', 0) — токен взят и действие помечено как выполняющееся
+    key = f"{chat_id}:{action}"
+    capacity, rate = RATE_LIMITS[action]
+    now = time.time()
+    with closing(limits_db()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM inflight WHERE since < ?", (now - INFLIGHT_TTL_SEC,))
+            if db.execute("SELECT 1 FROM inflight WHERE key = ?", (key,)).fetchone():
+                result = ('busy', 0)
+            else:
+                row    = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    db.execute("INSERT INTO inflight (key, since) VALUES (?, ?)", (key, now))
+                    result = ('ok', 0)
+                else:
+                    result = ('limited', (1 - tokens) / rate)
+                db.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    (key, tokens, now)
+                )
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    return result
+
+def try_mark(key: str) -> bool:
+    # та же метка «выполняется», но без лимита: межпроцессный замок по ключу
+    now = time.time()
+    with closing(limits_db()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM inflight WHERE since < ?", (now - INFLIGHT_TTL_SEC,))
+            cur = db.execute("INSERT OR IGNORE INTO inflight (key, since) VALUES (?, ?)", (key, now))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    return cur.rowcount == 1
+
+def touch_mark(key: str):
+    with closing(limits_db()) as db:
+        db.execute("UPDATE inflight SET since = ? WHERE key = ?", (time.time(), key))
+
+async def keep_mark_alive(key: str):
+    # метка переживает процесс: без продления она истечёт через INFLIGHT_TTL_SEC
+    # после падения или перезапуска реплики, а не повиснет на час
+    while True:
+        await asyncio.sleep(INFLIGHT_BEAT_SEC)
+        await asyncio.to_thread(touch_mark, key)
+
+def release_mark(key: str):
+    with closing(limits_db()) as db:
+        db.execute("DELETE FROM inflight WHERE key = ?", (key,))
+
+def load_too_high() -> bool:
+    try:
+        return os.getloadavg()[0] > MAX_LOAD_AVG
+    except (AttributeError, OSError):  # на Windows getloadavg нет
+        return False
+
+def renders_locally(action: str) -> bool:
+    # в режиме broker рендер идёт на воркерах: локальные слоты и load average
+    # его не касаются, ограничивает только длина общей очереди
+    return action in HEAVY_ACTIONS and not (action == 'render' and RENDER_MODE == 'broker')
+
+async def admit(chat_id: int, action: str):
+    # None — можно выполнять (и тогда обязательно через job_slot), иначе текст отказа.
+    # Локальный слот резервируется до первого await: иначе пачка одновременных
+    # запросов проходит проверку раньше, чем хоть один из них посчитан
+    global _heavy_jobs
+    heavy = renders_locally(action)
+    if heavy:
+        if _heavy_jobs >= MAX_ACTIVE_RENDERS + MAX_QUEUE_DEPTH or load_too_high():
+            return '🚦 Сервер перегружен, попробуйте через пару минут.'
+        _heavy_jobs += 1
+    try:
+        if action == 'render' and not heavy and await asyncio.to_thread(pending_renders) >= MAX_BROKER_QUEUE:
+            refusal = '🚦 Очередь рендера переполнена, попробуйте через пару минут.'
+        else:
+            status, wait = await asyncio.to_thread(claim_action, chat_id, action)
+            refusal = {
+                'busy':    '⏳ Уже выполняется, дождитесь результата.',
+                'limited': f'⏳ Слишком часто. Повторите через {math.ceil(wait)} с.',
+            }.get(status)
+    except BaseException:
+        if heavy:
+            _heavy_jobs -= 1
+        raise
+    if heavy and refusal:
+        _heavy_jobs -= 1
+    return refusal
+
+@asynccontextmanager
+async def job_slot(chat_id: int, action: str):
+    # после admit(): забирает его резерв в _heavy_jobs, тяжёлые задачи ждут
+    # локальный слот, метка «выполняется» снимается по выходу
+    global _heavy_jobs
+    heavy = renders_locally(action)
+    key   = f"{chat_id}:{action}"
+    beat  = asyncio.create_task(keep_mark_alive(key))
+    try:
+        if heavy:
+            async with _render_slots:
+                yield
+        else:
+            yield
+    finally:
+        beat.cancel()
+        if heavy:
+            _heavy_jobs -= 1
+        await asyncio.to_thread(release_mark, key)
+
+# === Rendering ===
+# аудио, которое mp4 принимает без перекодирования
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'ac3', 'eac3', 'alac'}
+
+def probe_video(video_file: str) -> dict:
+    # длительность, размер (после поворота) и fps первой видеодорожки, кодек первой
+    # аудиодорожки; probed=False — ffprobe не справился, планировщик действует по-старому
+    info = {'probed': False, 'duration': 0, 'width': 0, 'height': 0, 'fps': 0, 'audio': None}
+    try:
+        out = subprocess.check_output([
+            str(FFPROBE_BIN), '-v', 'error',
+            '-show_entries', 'stream=codec_type,codec_name,width,height,avg_frame_rate,r_frame_rate'
+                             ':stream_side_data=rotation:stream_tags=rotate:format=duration',
+            '-of', 'json', video_file
+        ])
+        data = json.loads(out)
+        info['duration'] = float(data.get('format', {}).get('duration') or 0)
+        for stream in data.get('streams') or []:
+            if stream.get('codec_type') == 'video' and not info['width']:
+                info['width']  = int(stream.get('width') or 0)
+                info['height'] = int(stream.get('height') or 0)
+                # ffmpeg по умолчанию поворачивает кадры по метаданным (телефонное
+                # вертикальное видео), поэтому и декодер отдаёт кадры с переставленными сторонами
+                rotation = next((d['rotation'] for d in stream.get('side_data_list') or []
+                                 if 'rotation' in d), (stream.get('tags') or {}).get('rotate', 0))
+                if abs(int(float(rotation))) % 180 == 90:
+                    info['width'], info['height'] = info['height'], info['width']
+                for rate in (stream.get('avg_frame_rate'), stream.get('r_frame_rate')):
+                    if rate and not rate.startswith('0') and not rate.endswith('/0'):
+                        info['fps'] = float(Fraction(rate))
+                        break
+            elif stream.get('codec_type') == 'audio' and info['audio'] is None:
+                info['audio'] = stream.get('codec_name') or 'unknown'
+        info['probed'] = True
+    except (subprocess.CalledProcessError, OSError, ValueError, ZeroDivisionError):
+        pass
+    return info
+
+def plan_audio(info: dict) -> str:
+    # none — дорожки нет, не маппим; copy — как есть; aac — перекодировать,
+    # иначе mp4-мультиплексор упадёт уже после кодирования видео
+    if not info['probed']:
+        return 'copy'
+    if info['audio'] is None:
+        return 'none'
+    return 'copy' if info['audio'] in MP4_AUDIO_CODECS else 'aac'
+
+DRAFT_SHORT_SIDE  = 480                       # черновик: короткая сторона холста
+RENDITION_PRESETS = [[], [720], [720, 1080]]  # короткие стороны; [] — один файл
+
+def even(x: float) -> int:
+    return max(2, int(round(x / 2)) * 2)
+
+def plan_canvas(s: dict, info: dict) -> tuple:
+    # холст по aspect, но не крупнее исходника: видео на нём не растягивается
+    # сверх своего разрешения; черновик и рендиции уменьшают его дальше
+    w, h  = (1080,1920) if s['aspect']=='9:16' else ((1920,1080) if s['aspect']=='16:9' else (1024,768))
+    vid_w = w * s['video_scale'] / 100
+    k     = min(1.0, info['width'] / vid_w) if info['width'] else 1.0
+    if s['quality'] == 'draft':
+        k = min(k, DRAFT_SHORT_SIDE / min(w, h))
+    short   = min(w, h) * k
+    targets = [] if s['quality'] == 'draft' else [r for r in sorted(set(s['renditions'])) if r <= short]
+    if targets:
+        k = targets[-1] / min(w, h)
+    cw, ch = even(w * k), even(h * k)
+    return cw, ch, cw / w, targets
+
+def plan_render(s: dict, img_path: str, out_file: Path, info: dict) -> dict:
+    # всё, что нужно воркеру для рендера одного варианта — только JSON-типы
+    w, h, k, targets = plan_canvas(s, info)
+    vid_w  = max(2, int(w * s['video_scale'] / 100))
+    length = info['duration']
+    out_file = Path(out_file)
+    if targets:
+        outputs = [
+            {'out': str(out_file.with_name(f"{out_file.stem}_{t}p{out_file.suffix}")),
+             'w': even(w * t / min(w, h)), 'h': even(h * t / min(w, h))}
+            for t in targets
+        ]
+    else:
+        outputs = [{'out': str(out_file), 'w': w, 'h': h}]
+    return {
+        'video': s['video_file'],
+        'image': img_path,
+        'outputs': outputs,
+        'w': w, 'h': h,
+        'img_w': int(w * s['img_scale'] / 100),
+        'img_h': int(h * s['img_scale'] / 100),
+        'vid_w': vid_w,
+        # как scale=W:-1 у ffmpeg; 0 — размер исходника неизвестен
+        'vid_h': round(vid_w * info['height'] / info['width']) if info['width'] else 0,
+        'alpha': 1 - s['alpha'] / 100,
+        'off_x': int(s['offset_x'] * k),
+        'off_y': int(s['offset_y'] * k),
+        'fps':   s['fps'],
+        'crf':   28 if s['quality'] == 'draft' else 20,
+        # fps исходника совпадает с нужным — кадры не пересчитываем
+        'convert_fps': not (info['fps'] and abs(info['fps'] - s['fps']) < 0.01),
+        'audio': plan_audio(info),
+        'dur':   length if s['animate'] else 0,
+        'length': length,   # для процента и ETA
+    }
+
+def overlay_filter(job: dict) -> str:
+    dur  = job['dur']
+    move = (
+        f"x='(main_w-overlay_w)*t/{dur}':y='(main_h-overlay_h)*t/{dur}'"
+        if dur > 0
+        else "x='(main_w-overlay_w)/2':y='(main_h-overlay_h)/2'"
+    )
+    return (
+        f"[1:v]scale={job['img_w']}:{job['img_h']},format=rgba[img];"
+        f"[2:v]scale={job['vid_w']}:-1,format=rgba,colorchannelmixer=aa={job['alpha']}[vid];"
+        f"[0:v][img]overlay={move}[tmp];"
+        f"[tmp][vid]overlay=x='(main_w-overlay_w)/2+{job['off_x']}':"
+        f"y='(main_h-overlay_h)/2+{job['off_y']}':shortest=1"
+    )
+
+def output_args(job: dict, video: str, audio_input: int, limit: float = None) -> tuple:
+    # все рендиции из одного декода: split + scale в том же графе.
+    # Возвращает (дополнение к filter_complex или None, аргументы выходов)
+    outs, graph, maps = job['outputs'], None, [video]
+    if len(outs) > 1 or (outs[0]['w'], outs[0]['h']) != (job['w'], job['h']):
+        src   = video if video.startswith('[') else f"[{video}]"
+        graph = ";".join(
+            [f"{src}split={len(outs)}" + "".join(f"[s{i}]" for i in range(len(outs)))]
+            + [f"[s{i}]scale={o['w']}:{o['h']},setsar=1[r{i}]" for i, o in enumerate(outs)]
+        )
+        maps = [f"[r{i}]" for i in range(len(outs))]
+    audio = {
+        'none': ['-an'],
+        'copy': ['-map', f'{audio_input}:a:0?', '-c:a', 'copy', '-shortest'],
+        'aac':  ['-map', f'{audio_input}:a:0?', '-c:a', 'aac', '-b:a', '160k', '-shortest'],
+    }[job['audio']]
+    args = []
+    for o, m in zip(outs, maps):
+        args += [
+            '-map', m, *audio,
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', str(job['crf']), '-pix_fmt', 'yuv420p',
+            *(['-r', str(job['fps'])] if job['convert_fps'] else []),
+            *(['-t', str(limit)] if limit else []), o['out']
+        ]
+    return graph, args
+
+def canvas_source(job: dict) -> str:
+    # холст сразу в целевом fps и ограничен длительностью видео, чтобы
+    # генератор не работал дольше исходника
+    src = f"color=black:s={job['w']}x{job['h']}:r={job['fps']}"
+    return src + (f":d={job['length']}" if job['length'] > 0 else '')
+
+def render_cmd(job: dict, limit: float = None) -> list:
+    # limit — рендерить только первые N секунд (для бенчмарка)
+    graph, outputs = output_args(job, '[v]', 2, limit)
+    return [
+        str(FFMPEG_BIN), '-y', '-f', 'lavfi', '-i', canvas_source(job),
+        '-i', job['image'], '-i', job['video'],
+        '-filter_complex', overlay_filter(job) + '[v]' + (';' + graph if graph else ''),
+        *outputs
+    ]
+
+async def render_variant(job: dict, on_progress=None):
+    Path(job['outputs'][0]['out']).parent.mkdir(parents=True, exist_ok=True)
+    if await pick_compositor(job) == 'numpy':
+        await composite_numpy(job, on_progress)
+    else:
+        await run_ffmpeg(render_cmd(job), job['length'], on_progress)
+
+# === Render Progress ===
+PROGRESS_EDIT_SEC = 3.0   # статус редактируем не чаще, чем раз в столько секунд
+
+def parse_progress(block: dict, length: float, elapsed: float) -> dict:
+    # block — один блок key=value из `-progress`, заканчивается строкой progress=...
+    try:
+        done = int(block.get('out_time_us') or block.get('out_time_ms') or 0) / 1e6
+    except ValueError:
+        done = 0
+    try:
+        fps = float(block.get('fps') or 0)
+    except ValueError:
+        fps = 0
+    try:
+        speed = float((block.get('speed') or '').rstrip('x'))
+    except ValueError:
+        speed = 0
+    pct = min(100.0, done / length * 100) if length > 0 else 0
+    if block.get('progress') == 'end':
+        pct, eta = 100.0, 0
+    elif speed > 0 and length > 0:
+        eta = max(0, (length - done) / speed)
+    elif pct > 0:
+        eta = elapsed * (100 - pct) / pct
+    else:
+        eta = None
+    return {'pct': pct, 'fps': fps, 'eta': eta}
+
+async def run_ffmpeg(cmd: list, length: float = 0, on_progress=None, feed=None):
+    # on_progress — корутина, получает dict из parse_progress на каждый блок;
+    # feed — корутина, пишущая вход ffmpeg в stdin (и закрывающая его)
+    cmd  = [cmd[0], '-progress', 'pipe:1', '-nostats', '-loglevel', 'error', *cmd[1:]]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.PIPE if feed else None,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stderr  = asyncio.create_task(proc.stderr.read())
+    feeder  = asyncio.create_task(feed(proc.stdin)) if feed else None
+    started = time.monotonic()
+    block   = {}
+    async for raw in proc.stdout:
+        key, _, value = raw.decode(errors='replace').strip().partition('=')
+        block[key] = value
+        if key == 'progress':
+            if on_progress:
+                await on_progress(parse_progress(block, length, time.monotonic() - started))
+            block = {}
+    err = await stderr
+    if await proc.wait() != 0:
+        if feeder:
+            feeder.cancel()
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=err)
+    if feeder:
+        await feeder
+
+def ffmpeg_error(e: subprocess.CalledProcessError) -> str:
+    # хвост stderr: с -loglevel error там только причина сбоя
+    err = e.stderr.decode(errors='replace') if isinstance(e.stderr, bytes) else (e.stderr or '')
+    return err.strip()[-300:] or str(e)
+
+def format_eta(sec) -> str:
+    if sec is None:
+        return '…'
+    sec = int(sec)
+    return f"{sec // 60}:{sec % 60:02d}"
+
+class ProgressMessage:
+    # один редактируемый статус на задачу вместо потока сообщений
+    def __init__(self, bot, chat_id: int, total: int):
+        self.bot       = bot
+        self.chat_id   = chat_id
+        self.total     = total
+        self.message   = None
+        self.last_edit = 0.0
+        self.last_text = None
+
+    async def update(self, variant: int, progress, force: bool = False):
+        if progress is None:
+            text = f"🕓 Вариант {variant}/{self.total}: в очереди"
+        else:
+            text = (f"⏳ Вариант {variant}/{self.total}: {progress['pct']:.0f}% · "
+                    f"{progress['fps']:.0f} fps · осталось {format_eta(progress['eta'])}")
+        await self._show(text, force)
+
+    async def finish(self, text: str):
+        await self._show(text, force=True)
+
+    async def _show(self, text: str, force: bool):
+        now = time.monotonic()
+        if text == self.last_text or (not force and now - self.last_edit < PROGRESS_EDIT_SEC):
+            return
+        self.last_edit, self.last_text = now, text
+        try:
+            if self.message is None:
+                self.message = await self.bot.send_message(self.chat_id, text)
+            else:
+                await self.message.edit_text(text)
+        except Exception:
+            pass  # статус вспомогательный — сбой Telegram не должен ронять рендер
+
+# === NumPy Compositor ===
+# Без анимации холст с картинкой не меняется от кадра к кадру: считаем его
+# один раз, а на каждый кадр только смешиваем видео с готовым фоном.
+# ffmpeg лишь декодирует видео в сырой RGB и кодирует результат.
+COMPOSITOR      = CONFIG["COMPOSITOR"]
+COMPOSITOR_FILE = SETTINGS_DIR / "compositor.json"   # бенчмарк по размеру холста и числу рендиций
+BENCH_SEC       = 3
+_compositor_choice: dict = {}
+
+def numpy_available() -> bool:
+    return importlib.util.find_spec('numpy') is not None
+
+def background_cmd(job: dict) -> list:
+    return [
+        str(FFMPEG_BIN), '-v', 'error', '-f', 'lavfi', '-i', f"color=black:s={job['w']}x{job['h']}",
+        '-i', job['image'], '-filter_complex',
+        (f"[1:v]scale={job['img_w']}:{job['img_h']},format=rgba[img];"
+         f"[0:v][img]overlay=x='(main_w-overlay_w)/2':y='(main_h-overlay_h)/2',format=rgb24"),
+        '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1'
+    ]
+
+def decode_cmd(job: dict, limit: float = None) -> list:
+    return [
+        str(FFMPEG_BIN), '-v', 'error', *(['-t', str(limit)] if limit else []), '-i', job['video'],
+        '-vf', f"scale={job['vid_w']}:{job['vid_h']}" + (f",fps={job['fps']}" if job['convert_fps'] else ''),
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1'
+    ]
+
+def encode_cmd(job: dict, limit: float = None) -> list:
+    graph, outputs = output_args(job, '0:v', 1, limit)
+    return [
+        str(FFMPEG_BIN), '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+        '-s', f"{job['w']}x{job['h']}", '-r', str(job['fps']), '-i', 'pipe:0',
+        '-i', job['video'], *(['-filter_complex', graph] if graph else []), *outputs
+    ]
+
+class FrameBlender:
+    def __init__(self, job: dict, background: bytes):
+        import numpy as np
+        self.np = np
+        w, h   = job['w'], job['h']
+        vw, vh = job['vid_w'], job['vid_h']
+        self.shape = (vh, vw, 3)
+        self.out   = np.frombuffer(background, np.uint8).reshape(h, w, 3).copy()
+        # как overlay x='(main_w-overlay_w)/2+off_x', с обрезкой по краям холста
+        x, y   = (w - vw) // 2 + job['off_x'], (h - vh) // 2 + job['off_y']
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + vw, w), min(y + vh, h)
+        self.visible = x1 > x0 and y1 > y0
+        self.dst = (slice(y0, y1), slice(x0, x1))
+        self.src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        # альфа в 1/256: фон под видео домножаем заранее, на кадр остаётся одно умножение
+        self.a  = round(job['alpha'] * 256)
+        self.bg = self.out[self.dst].astype(np.uint16) * (256 - self.a)
+
+    def blend(self, raw: bytes) -> bytes:
+        if self.visible:
+            frame = self.np.frombuffer(raw, self.np.uint8).reshape(self.shape)[self.src]
+            if self.a >= 256:
+                self.out[self.dst] = frame
+            else:
+                self.out[self.dst] = (frame.astype(self.np.uint16) * self.a + self.bg) >> 8
+        return self.out.tobytes()
+
+async def composite_numpy(job: dict, on_progress=None, limit: float = None):
+    bg = await asyncio.to_thread(subprocess.run, background_cmd(job), capture_output=True, check=True)
+    blender    = FrameBlender(job, bg.stdout)
+    frame_size = job['vid_w'] * job['vid_h'] * 3
+
+    async def feed(stdin):
+        cmd = decode_cmd(job, limit)
+        dec = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        dec_err = asyncio.create_task(dec.stderr.read())
+        try:
+            while True:
+                try:
+                    raw = await dec.stdout.readexactly(frame_size)
+                except asyncio.IncompleteReadError:
+                    break
+                stdin.write(await asyncio.to_thread(blender.blend, raw))
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # энкодер закрыл вход сам (например, -t): это конец данных, а не сбой;
+            # его код возврата проверит run_ffmpeg. Остаток stdout декодера дочитываем,
+            # иначе канал не закроется и wait() не вернётся
+            dec.kill()
+            await dec.stdout.read()
+            await dec.wait()
+            await dec_err
+            return
+        except BaseException:
+            if dec.returncode is None:
+                dec.kill()
+            raise
+        finally:
+            stdin.close()
+        if await dec.wait() != 0:
+            raise subprocess.CalledProcessError(dec.returncode, cmd, stderr=await dec_err)
+
+    length = min(job['length'], limit) if limit else job['length']
+    await run_ffmpeg(encode_cmd(job, limit), length, on_progress, feed)
+
+async def benchmark_compositors(job: dict) -> dict:
+    # оба бэкенда на первых BENCH_SEC секундах того же задания; имена файлов
+    # уникальны: бенчмарки разных чатов и процессов идут параллельно
+    tag     = uuid.uuid4().hex[:12]
+    sample  = dict(job, outputs=[
+        dict(o, out=str(SETTINGS_DIR / f"bench_{tag}_{i}.mp4")) for i, o in enumerate(job['outputs'])
+    ])
+    try:
+        started = time.perf_counter()
+        await run_ffmpeg(render_cmd(sample, BENCH_SEC))
+        ffmpeg_sec = time.perf_counter() - started
+        started = time.perf_counter()
+        try:
+            await composite_numpy(sample, limit=BENCH_SEC)
+            numpy_sec = time.perf_counter() - started
+        except (subprocess.CalledProcessError, OSError, ImportError):
+            numpy_sec = None
+    finally:
+        for o in sample['outputs']:
+            try:
+                Path(o['out']).unlink(missing_ok=True)
+            except OSError:   # на Windows файл ещё может держать ffmpeg
+                pass
+    faster = numpy_sec is not None and numpy_sec < ffmpeg_sec
+    return {
+        'choice':     'numpy' if faster else 'ffmpeg',
+        'ffmpeg_sec': round(ffmpeg_sec, 3),
+        'numpy_sec':  round(numpy_sec, 3) if numpy_sec is not None else None,
+        'measured':   datetime.utcnow().isoformat(),
+    }
+
+def load_compositor_cache() -> dict:
+    try:
+        return json.loads(COMPOSITOR_FILE.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+async def pick_compositor(job: dict) -> str:
+    # numpy годится только для статичного фона и известного размера видео
+    if job['dur'] > 0 or not job['vid_h'] or not numpy_available():
+        return 'ffmpeg'
+    if COMPOSITOR != 'auto':
+        return COMPOSITOR
+    key = f"{job['w']}x{job['h']}x{len(job['outputs'])}"
+    if key not in _compositor_choice:
+        cache = load_compositor_cache()
+        if key not in cache:
+            result = await benchmark_compositors(job)
+            # пока шёл бенчмарк, файл могли дополнить другие процессы: перечитываем
+            cache = load_compositor_cache()
+            cache.setdefault(key, result)
+            write_atomic(COMPOSITOR_FILE, json.dumps(cache, indent=2))
+        _compositor_choice[key] = cache[key]['choice']
+    return _compositor_choice[key]
+
+# === Render Queue ===
+# local — рендер в процессе бота; broker — бот только ставит задачи в очередь
+# (SQLite в общем SETTINGS_DIR), а рендерят отдельные `python tg.py worker`
+RENDER_MODE     = CONFIG["RENDER_MODE"]
+RENDER_DB       = SETTINGS_DIR / "render_queue.db"
+JOB_POLL_SEC    = 1.0
+STALE_JOB_SEC   = 300    # running без отчёта о прогрессе дольше этого — воркер умер
+QUEUED_JOB_SEC  = 3 * STALE_JOB_SEC   # queued дольше этого — воркеров нет, отказываем
+DONE_JOB_SEC    = 24 * 3600           # done/failed, которые бот так и не забрал
+
+def queue_db() -> sqlite3.Connection:
+    # без WAL: он не работает на сетевых дисках
+    db = sqlite3.connect(RENDER_DB, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " chat_id INTEGER NOT NULL,"
+        " payload TEXT NOT NULL,"
+        " status TEXT NOT NULL DEFAULT 'queued',"   # queued | running | done | failed
+        " worker TEXT,"
+        " progress TEXT,"   # последний dict из parse_progress
+        " error TEXT,"
+        " created REAL NOT NULL,"
+        " updated REAL NOT NULL)"
+    )
+    return db
+
+def share_path(path: str) -> str:
+    # в очередь пути пишутся относительно SETTINGS_DIR: у воркера общий каталог
+    # может быть смонтирован в другом месте (и у него свой cwd)
+    p = Path(path).resolve()
+    try:
+        return str(p.relative_to(SETTINGS_DIR.resolve()))
+    except ValueError:
+        return str(p)
+
+def local_path(path: str) -> str:
+    # абсолютный путь Path оставит как есть
+    return str(SETTINGS_DIR / path)
+
+def map_job_paths(job: dict, fn) -> dict:
+    return dict(job, video=fn(job['video']), image=fn(job['image']),
+                outputs=[dict(o, out=fn(o['out'])) for o in job['outputs']])
+
+def enqueue_render(chat_id: int, job: dict) -> int:
+    now = time.time()
+    with closing(queue_db()) as db:
+        cur = db.execute(
+            "INSERT INTO jobs (chat_id, payload, created, updated) VALUES (?, ?, ?, ?)",
+            (chat_id, json.dumps(map_job_paths(job, share_path)), now, now)
+        )
+        return cur.lastrowid
+
+def pending_renders() -> int:
+    with closing(queue_db()) as db:
+        return db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+def claim_render(worker: str):
+    # атомарно забирает самую старую задачу: (id, job) или None
+    now = time.time()
+    with closing(queue_db()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND updated < ?",
+                (now - STALE_JOB_SEC,)
+            )
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                (now - DONE_JOB_SEC,)
+            )
+            row = db.execute(
+                "SELECT id, payload FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, updated = ? WHERE id = ?",
+                    (worker, now, row['id'])
+                )
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    return (row['id'], map_job_paths(json.loads(row['payload']), local_path)) if row else None
+
+def finish_render(job_id: int, error: str = None):
+    with closing(queue_db()) as db:
+        db.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+            ('failed' if error else 'done', error, time.time(), job_id)
+        )
+
+def expire_render(job_id: int, error: str) -> bool:
+    # failed только если задачу так никто и не взял; False — воркер успел
+    with closing(queue_db()) as db:
+        cur = db.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ? AND status = 'queued'",
+            (error, time.time(), job_id)
+        )
+        return cur.rowcount == 1
+
+def delete_render(job_id: int):
+    # результат доставлен (или ошибка показана): строка больше не нужна
+    with closing(queue_db()) as db:
+        db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+def report_progress(job_id: int, progress: dict):
+    # заодно служит heartbeat'ом воркера
+    with closing(queue_db()) as db:
+        db.execute(
+            "UPDATE jobs SET progress = ?, updated = ? WHERE id = ?",
+            (json.dumps(progress), time.time(), job_id)
+        )
+
+def render_status(job_id: int) -> sqlite3.Row:
+    with closing(queue_db()) as db:
+        return db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+async def wait_render(job_id: int, on_progress=None):
+    # None — готово, иначе текст ошибки воркера
+    while True:
+        row = await asyncio.to_thread(render_status, job_id)
+        if row['status'] == 'done':
+            return None
+        if row['status'] == 'failed':
+            return row['error'] or 'unknown error'
+        if row['status'] == 'queued' and time.time() - row['created'] > QUEUED_JOB_SEC:
+            error = 'нет свободных воркеров рендера, попробуйте позже'
+            if await asyncio.to_thread(expire_render, job_id, error):
+                return error
+            continue
+        if on_progress:
+            await on_progress(json.loads(row['progress']) if row['progress'] else None)
+        await asyncio.sleep(JOB_POLL_SEC)
+
+def run_worker(once: bool = False):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"render worker {worker} started, queue: {RENDER_DB}")
+    while True:
+        claimed = claim_render(worker)
+        if not claimed:
+            if once:
+                return
+            time.sleep(JOB_POLL_SEC)
+            continue
+        job_id, job = claimed
+        last_report = 0.0
+
+        async def report(progress, job_id=job_id):
+            nonlocal last_report
+            if time.monotonic() - last_report >= JOB_POLL_SEC or progress['pct'] >= 100:
+                last_report = time.monotonic()
+                await asyncio.to_thread(report_progress, job_id, progress)
+
+        try:
+            asyncio.run(render_variant(job, report))
+        except subprocess.CalledProcessError as e:
+            finish_render(job_id, ffmpeg_error(e))
+        except Exception as e:
+            finish_render(job_id, str(e)[:300])
+        else:
+            finish_render(job_id)
+
+# === Generation Cache ===
+# Картинки FusionBrain по ключу (нормализованный промт, размер, пайплайн):
+# повторный промт отдаётся с диска, одинаковые запросы ждут друг друга,
+# старые записи вытесняются по времени последнего обращения.
+GEN_CACHE_DIR       = SETTINGS_DIR / "gen_cache"
+GEN_CACHE_MAX_BYTES = 500 * 1024 * 1024
+GEN_WIDTH, GEN_HEIGHT = 512, 512
+GEN_LOCK_POLL_SEC   = 1.0   # как часто ждущая реплика проверяет замок промта
+_gen_locks: dict = {}   # key -> [Lock, сколько запросов держат/ждут]
+
+def gen_cache_key(prompt: str, width: int, height: int, pipeline_id) -> str:
+    normalized = " ".join(prompt.lower().split())
+    raw = json.dumps([normalized, width, height, str(pipeline_id)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+def cached_images(key: str) -> list:
+    d = GEN_CACHE_DIR / key
+    if not d.exists():
+        return []
+    d.touch()   # mtime каталога — последнее обращение, для вытеснения
+    return sorted(d.glob("*.png"))
+
+def store_image(key: str, data: bytes) -> Path:
+    d = GEN_CACHE_DIR / key
+    d.mkdir(parents=True, exist_ok=True)
+    p = d / f"{time.time_ns()}.png"   # уникально и между процессами
+    write_atomic(p, data)   # cached_images() другого процесса не увидит недописанный png
+    return p
+
+def prune_gen_cache():
+    # вызывается из finally генерации: не бросает, даже если каталоги кэша
+    # параллельно удаляет/дополняет другой процесс
+    entries = []
+    try:
+        dirs = list(GEN_CACHE_DIR.iterdir())
+    except OSError:   # кэша ещё нет
+        return
+    for d in dirs:
+        try:
+            if d.is_dir():
+                entries.append((d.stat().st_mtime, sum(f.stat().st_size for f in d.iterdir()), d))
+        except OSError:   # удалён или дописывается прямо сейчас — пропускаем
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, d in sorted(entries):
+        if total <= GEN_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(d, ignore_errors=True)
+        total -= size
+
+@asynccontextmanager
+async def prompt_lock(key: str):
+    # локальный Lock выстраивает запросы процесса, метка в limits.db — реплики
+    entry = _gen_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            mark = f"gen:{key}"
+            while not await asyncio.to_thread(try_mark, mark):
+                await asyncio.sleep(GEN_LOCK_POLL_SEC)
+            beat = asyncio.create_task(keep_mark_alive(mark))
+            try:
+                yield
+            finally:
+                beat.cancel()
+                await asyncio.to_thread(release_mark, mark)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _gen_locks.pop(key, None)
+
 # === Main Menu ===
-async def send_main_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    settings = await load_chat_settings(chat_id)
+def main_menu_markup(chat_id: int, settings: dict):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     gen_label = "🎨 Генерация: ✔️" if settings['use_img_gen'] else "🎨 Генерация: ❌"
     kb = [
         [InlineKeyboardButton(gen_label, callback_data="toggle_img_gen")],
@@ -182,11 +1107,16 @@ async def send_main_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     ]
     if chat_id == ADMIN_ID:
         kb.append([InlineKeyboardButton("🛠️ Админ панель", callback_data="admin_panel")])
-    await context.bot.send_message(chat_id, "✨ Главное меню:", reply_markup=InlineKeyboardMarkup(kb))
+    return InlineKeyboardMarkup(kb)
+
+async def send_main_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    settings = await load_chat_settings(chat_id)
+    await context.bot.send_message(chat_id, "✨ Главное меню:", reply_markup=main_menu_markup(chat_id, settings))
 
 # === Handlers ===
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     uid = update.effective_chat.id
 
     # проверяем только approved_users.json
@@ -200,7 +1130,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 await update.message.reply_text(
                     "⏳ Вы уже подавали заявку недавно, повторить можно через час."
                 )
-                return ConversationHandler.END
+                return END
 
         # отмечаем время этой попытки
         stats['last_request'] = now.isoformat()
@@ -221,7 +1151,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text(
             "🟣Заявка была отправлена Администратору @durovpickme. Ожидайте"
         )
-        return ConversationHandler.END
+        return END
 
     # если уже в списке approved_users.json
     await update.message.reply_text("✨ Добро пожаловать!")
@@ -240,7 +1170,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text(
                 "❌ Доступ забран администратором. Чтобы подать новую заявку, используйте /start"
             )
-        return ConversationHandler.END
+        return END
 
     query = update.callback_query
     await query.answer()
@@ -253,28 +1183,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         settings['use_img_gen'] = not settings['use_img_gen']
         await save_chat_settings(chat_id, settings)
 
-        # строим обновлённую клавиатуру главного меню
-        gen_label = "🎨 Генерация: ✔️" if settings['use_img_gen'] else "🎨 Генерация: ❌"
-        kb = [
-            [InlineKeyboardButton(gen_label, callback_data="toggle_img_gen")],
-            [
-                InlineKeyboardButton("🎬 Видео", callback_data="upload_video"),
-                InlineKeyboardButton("🖼️ Картинки", callback_data="upload_images")
-            ],
-            [
-                InlineKeyboardButton("🔍 Предпросмотр", callback_data="preview"),
-                InlineKeyboardButton("🚀 Старт", callback_data="start_process")
-            ],
-            [
-                InlineKeyboardButton("⚙️ Настройки", callback_data="settings"),
-                InlineKeyboardButton("📊 Статистика", callback_data="stats")
-            ]
-        ]
-        if chat_id == ADMIN_ID:
-            kb.append([InlineKeyboardButton("🛠️ Админ панель", callback_data="admin_panel")])
-
-        # просто обновляем разметку на месте
-        await query.edit_message_reply_markup(InlineKeyboardMarkup(kb))
+        # просто обновляем разметку главного меню на месте
+        await query.edit_message_reply_markup(main_menu_markup(chat_id, settings))
         return CONFIGURING
 
     # Prompt for FusionBrain если включена генерация
@@ -289,10 +1199,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if data == 'upload_images':
         await context.bot.send_message(chat_id, 'Отправьте картинки или ZIP:')
         return UPLOADING_IMAGES
-    if data == 'preview':
-        return await preview(update, context)
-    if data == 'start_process':
-        return await start_processing(update, context)
+    if data in ('preview', 'start_process'):
+        action  = 'preview' if data == 'preview' else 'render'
+        refusal = await admit(chat_id, action)
+        if refusal:
+            await context.bot.send_message(chat_id, refusal)
+            return CONFIGURING
+        async with job_slot(chat_id, action):
+            if action == 'preview':
+                return await preview(update, context)
+            return await start_processing(update, context)
     if data == 'settings':
         return await settings_menu(query, settings)
     if data == 'stats':
@@ -306,8 +1222,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if data == 'admin_panel' and chat_id == ADMIN_ID:
         return await admin_panel(update, context)
     if data.startswith('user_') and chat_id == ADMIN_ID:
-        uid = int(data.split('_', 1)[1])
-        return await user_stats(update, context, uid)
+        return await user_stats(update, context)
     if data == 'back_main':
         await query.edit_message_text('✨ Главное меню:')
         await send_main_menu(chat_id, context)
@@ -330,11 +1245,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         settings['aspect'] = opts[(idx + (1 if data=='aspect_next' else -1)) % len(opts)]
     elif data == 'animate_toggle':
         settings['animate'] = not settings['animate']
+    elif data == 'quality_toggle':
+        settings['quality'] = 'full' if settings['quality'] == 'draft' else 'draft'
+    elif data == 'renditions_next':
+        idx = RENDITION_PRESETS.index(settings['renditions']) if settings['renditions'] in RENDITION_PRESETS else 0
+        settings['renditions'] = RENDITION_PRESETS[(idx + 1) % len(RENDITION_PRESETS)]
 
     await save_chat_settings(chat_id, settings)
     return await settings_menu(query, settings)
 
 async def approval_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     query = update.callback_query
     await query.answer()
     action, uid_str = query.data.split("_",1)
@@ -367,6 +1288,7 @@ async def approval_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return CONFIGURING
 
 async def settings_menu(query, settings: dict) -> int:
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     kb = [
         [
             InlineKeyboardButton(f"Прозрачность: {settings['alpha']}%", callback_data='alpha_minus'),
@@ -395,6 +1317,13 @@ async def settings_menu(query, settings: dict) -> int:
         [
             InlineKeyboardButton(f"Анимация: {'✔' if settings['animate'] else '✖'}", callback_data='animate_toggle')
         ],
+        [
+            InlineKeyboardButton(f"Качество: {'черновик' if settings['quality'] == 'draft' else 'полное'}", callback_data='quality_toggle'),
+            InlineKeyboardButton(
+                "Версии: " + ('+'.join(f"{r}p" for r in settings['renditions']) or 'авто'),
+                callback_data='renditions_next'
+            )
+        ],
         [
             InlineKeyboardButton(f"Сдвиг X: {settings['offset_x']}", callback_data='set_offx'),
             InlineKeyboardButton(f"Сдвиг Y: {settings['offset_y']}", callback_data='set_offy')
@@ -412,7 +1341,7 @@ async def upload_video_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(
             "❌ Доступ забран администратором. Чтобы подать новую заявку, используйте /start"
         )
-        return ConversationHandler.END
+        return END
 
     # привязываем chat_id
     chat_id = uid
@@ -421,7 +1350,7 @@ async def upload_video_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     media = update.message.video or update.message.document
 
     if text.startswith('http'):
-        resp = requests.get(text, stream=True); resp.raise_for_status()
+        resp = await asyncio.to_thread(http_session().get, text, stream=True); resp.raise_for_status()
         suf  = Path(text).suffix or '.mp4'
         p    = SETTINGS_DIR / f"{chat_id}_video{suf}"
         with open(p, 'wb') as f:
@@ -504,36 +1433,16 @@ async def preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await send_main_menu(chat_id, context)
         return CONFIGURING
 
-    w, h = (1080,1920) if s['aspect']=='9:16' else ((1920,1080) if s['aspect']=='16:9' else (1024,768))
-    alpha = 1 - s['alpha']/100
-    img_w, img_h = int(w*s['img_scale']/100), int(h*s['img_scale']/100)
-    vid_w = int(w*s['video_scale']/100)
-    off_x, off_y = s['offset_x'], s['offset_y']
-    dur = 0
-    if s['animate']:
-        try:
-            out = subprocess.check_output([
-                str(FFPROBE_BIN), '-v','error','-show_entries','format=duration',
-                '-of','default=noprint_wrappers=1:nokey=1', s['video_file']
-            ])
-            dur = float(out)
-        except:
-            dur = 0
-    move = (f"x='(main_w-overlay_w)*t/{dur}':y='(main_h-overlay_h)*t/{dur}'" if s['animate'] and dur>0
-            else "x='(main_w-overlay_w)/2':y='(main_h-overlay_h)/2'")
+    info = await asyncio.to_thread(probe_video, s['video_file'])
     preview_file = SETTINGS_DIR / f"{chat_id}_preview.png"
+    job = plan_render(s, s['images'][0], preview_file, info)
     cmd = [
-        str(FFMPEG_BIN), '-y','-f','lavfi','-i',f"color=black:s={w}x{h}",
-        '-i',s['images'][0],'-i',s['video_file'],
-        '-filter_complex',
-        (f"[1:v]scale={img_w}:{img_h},format=rgba[img];"
-         f"[2:v]scale={vid_w}:-1,format=rgba,colorchannelmixer=aa={alpha}[vid];"
-         f"[0:v][img]overlay={move}[tmp];"
-         f"[tmp][vid]overlay=x='(main_w-overlay_w)/2+{off_x}':"
-         f"y='(main_h-overlay_h)/2+{off_y}':shortest=1"),
+        str(FFMPEG_BIN), '-y','-f','lavfi','-i',f"color=black:s={job['w']}x{job['h']}",
+        '-i',job['image'],'-i',job['video'],
+        '-filter_complex', overlay_filter(job),
         '-frames:v','1',str(preview_file)
     ]
-    subprocess.run(cmd, check=True)
+    await asyncio.to_thread(subprocess.run, cmd, check=True)
     await context.bot.send_photo(chat_id, open(preview_file,'rb'))
     await send_main_menu(chat_id, context)
     return CONFIGURING
@@ -551,51 +1460,71 @@ async def generate_image_with_count(update: Update, context: ContextTypes.DEFAUL
         await context.bot.send_message(chat_id, "❌ Введите целое число от 1 до 10.")
         return AWAITING_IMG_COUNT
 
-    prompt = context.user_data.get('img_prompt')
+    settings = await load_chat_settings(chat_id)
+    prompt   = settings['img_prompt']
     if not prompt:
         await context.bot.send_message(chat_id, "❌ Пропт не найден. Начните заново (/start).")
         return CONFIGURING
 
-    await context.bot.send_message(chat_id, f"⏳ Генерирую {n} изображений…")
+    refusal = await admit(chat_id, 'img_gen')
+    if refusal:
+        await context.bot.send_message(chat_id, refusal)
+        return AWAITING_IMG_COUNT
+    async with job_slot(chat_id, 'img_gen'):
+        return await _generate_images(chat_id, prompt, n, context)
 
-    api = FusionBrainAPI(
-        url="https://api-key.fusionbrain.ai/",
-        api_key="F2566ABF386C604F384B976F56D76D40",
-        secret_key="056DA47E786A5A5550062476E5EAF582"
-    )
+async def _generate_images(chat_id: int, prompt: str, n: int, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await context.bot.send_message(chat_id, f"⏳ Генерирую {n} изображений…")
 
     imgs_dir = SETTINGS_DIR / f"{chat_id}_gen_imgs"
     imgs_dir.mkdir(exist_ok=True)
     paths = []
 
-    try:
-        pipeline_id = api.get_pipeline()
-
-        for i in range(1, n + 1):
-            # 2) Отдельный запрос для каждого изображения
-            job_uuid = api.generate(prompt, pipeline_id, images=1, width=512, height=512)
-            files    = await asyncio.to_thread(api.check_generation, job_uuid)
-            if not files:
-                await context.bot.send_message(chat_id, f"❌ Таймаут на изображении {i}.")
-                continue
-
-            # FusionBrain возвращает ровно один файл
-            item = files[0]
+    async def deliver(i: int, img_bytes: bytes):
+        # копия в папке чата: вытеснение из кэша не ломает settings['images']
+        p = imgs_dir / f"gen_{i}.png"
+        p.write_bytes(img_bytes)
+        paths.append(str(p))
+        await context.bot.send_photo(chat_id, img_bytes)
 
-            # скачиваем URL или декодируем Base64
-            if item.startswith("http"):
-                resp = await asyncio.to_thread(requests.get, item)
-                resp.raise_for_status()
-                img_bytes = resp.content
-            else:
-                b64 = item.split("base64,")[-1]
-                img_bytes = base64.b64decode(b64)
-
-            # сохраняем и отправляем
-            p = imgs_dir / f"gen_{i}.png"
-            p.write_bytes(img_bytes)
-            paths.append(str(p))
-            await context.bot.send_photo(chat_id, img_bytes)
+    try:
+        api = fusion_brain()
+        pipeline_id = await asyncio.to_thread(api.get_pipeline)
+        key = gen_cache_key(prompt, GEN_WIDTH, GEN_HEIGHT, pipeline_id)
+
+        # одинаковый промт в полёте: ждём его и берём результат из кэша
+        async with prompt_lock(key):
+            cached = (await asyncio.to_thread(cached_images, key))[:n]
+            if cached:
+                await context.bot.send_message(chat_id, f"⚡ Из кэша: {len(cached)}")
+            for i, p in enumerate(cached, 1):
+                await deliver(i, p.read_bytes())
+
+            for i in range(len(cached) + 1, n + 1):
+                # 2) Отдельный запрос для каждого изображения
+                job_uuid = await asyncio.to_thread(
+                    api.generate, prompt, pipeline_id, images=1, width=GEN_WIDTH, height=GEN_HEIGHT
+                )
+                files    = await asyncio.to_thread(api.check_generation, job_uuid)
+                if not files:
+                    await context.bot.send_message(chat_id, f"❌ Таймаут на изображении {i}.")
+                    continue
+
+                # FusionBrain возвращает ровно один файл
+                item = files[0]
+
+                # скачиваем URL или декодируем Base64
+                if item.startswith("http"):
+                    resp = await asyncio.to_thread(http_session().get, item)
+                    resp.raise_for_status()
+                    img_bytes = resp.content
+                else:
+                    b64 = item.split("base64,")[-1]
+                    img_bytes = base64.b64decode(b64)
+
+                # сохраняем в кэш и отправляем
+                await asyncio.to_thread(store_image, key, img_bytes)
+                await deliver(i, img_bytes)
 
     except Exception as e:
         msg = str(e)
@@ -603,12 +1532,14 @@ async def generate_image_with_count(update: Update, context: ContextTypes.DEFAUL
             msg = msg[:300] + "…"
         await context.bot.send_message(chat_id, f"❌ Ошибка генерации: {msg}")
         return CONFIGURING
+    finally:
+        await asyncio.to_thread(prune_gen_cache)
 
     # 3) Обновляем settings и чистим временные данные
     settings = await load_chat_settings(chat_id)
     settings['images'] = paths
+    settings['img_prompt'] = None
     await save_chat_settings(chat_id, settings)
-    context.user_data.pop('img_prompt', None)
 
     # 4) Возвращаемся в меню
     await send_main_menu(chat_id, context)
@@ -620,10 +1551,12 @@ async def generate_image_handler(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text(
             "❌ Доступ забран администратором. Чтобы подать новую заявку, используйте /start"
         )
-        return ConversationHandler.END
+        return END
 
     prompt = update.message.text.strip()
-    context.user_data['img_prompt'] = prompt
+    s = await load_chat_settings(uid)
+    s['img_prompt'] = prompt
+    await save_chat_settings(uid, s)
     await context.bot.send_message(
         uid,
         f"Промт сохранён:\n«{prompt}»\n\nСколько изображений сгенерировать? (введите число)"
@@ -636,7 +1569,7 @@ async def start_processing(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text(
             "❌ Доступ забран администратором. Чтобы подать новую заявку, используйте /start"
         )
-        return ConversationHandler.END
+        return END
         
     query = update.callback_query
     await query.answer()
@@ -654,57 +1587,54 @@ async def start_processing(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return CONFIGURING
 
     # параметры
-    w, h = (1080,1920) if s['aspect']=='9:16' else ((1920,1080) if s['aspect']=='16:9' else (1024,768))
     out_dir = SETTINGS_DIR / f"{chat_id}_results"
     out_dir.mkdir(exist_ok=True)
+    info = await asyncio.to_thread(probe_video, s['video_file'])
+    # контейнер всегда mp4, какое бы ни было расширение исходника: plan_audio
+    # рассчитан на mp4-мультиплексор
+    jobs = [
+        plan_render(s, random.choice(s['images']), out_dir / f"uniq_{i}_{Path(s['video_file']).stem}.mp4", info)
+        for i in range(1, s['n'] + 1)
+    ]
+    status = ProgressMessage(context.bot, chat_id, len(jobs))
 
     # считаем новую сессию
     await update_user_stat(chat_id, 'sessions', 1)
 
+    # в режиме broker сразу ставим все варианты, чтобы воркеры рендерили их параллельно
+    if RENDER_MODE == 'broker':
+        job_ids = [await asyncio.to_thread(enqueue_render, chat_id, job) for job in jobs]
+
     # сам цикл рендеринга
-    for i in range(1, s['n'] + 1):
-        img_path = random.choice(s['images'])
-        out_file = out_dir / f"uniq_{i}_{Path(s['video_file']).name}"
-        alpha    = 1 - s['alpha'] / 100
-        off_x, off_y = s['offset_x'], s['offset_y']
-        img_w, img_h = int(w * s['img_scale'] / 100), int(h * s['img_scale'] / 100)
-        vid_w = int(w * s['video_scale'] / 100)
-        dur = 0
-        if s['animate']:
+    delivered = 0
+    for i, job in enumerate(jobs, 1):
+        on_progress = lambda p, i=i: status.update(i, p)
+        if RENDER_MODE == 'broker':
             try:
-                out = subprocess.check_output([
-                    str(FFPROBE_BIN), '-v', 'error', '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1', s['video_file']
-                ])
-                dur = float(out)
-            except:
-                dur = 0
-        move = (
-            f"x='(main_w-overlay_w)*t/{dur}':y='(main_h-overlay_h)*t/{dur}'"
-            if s['animate'] and dur > 0
-            else "x='(main_w-overlay_w)/2':y='(main_h-overlay_h)/2'"
-        )
-
-        cmd = [
-            str(FFMPEG_BIN), '-y', '-f', 'lavfi', '-i', f"color=black:s={w}x{h}",
-            '-i', img_path, '-i', s['video_file'], '-filter_complex',
-            (
-                f"[1:v]scale={img_w}:{img_h},format=rgba[img];"
-                f"[2:v]scale={vid_w}:-1,format=rgba,colorchannelmixer=aa={alpha}[vid];"
-                f"[0:v][img]overlay={move}[tmp];"
-                f"[tmp][vid]overlay=x='(main_w-overlay_w)/2+{off_x}':"
-                f"y='(main_h-overlay_h)/2+{off_y}':shortest=1"
-            ),
-            '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '20',
-            '-r', str(s['fps']), '-c:a', 'copy', str(out_file)
-        ]
-        subprocess.run(cmd, check=True)
+                error = await wait_render(job_ids[i - 1], on_progress)
+            finally:
+                await asyncio.to_thread(delete_render, job_ids[i - 1])
+            if error:
+                await context.bot.send_message(chat_id, f"❌ Вариант {i} не удался: {error}")
+                continue
+        else:
+            try:
+                await render_variant(job, on_progress)
+            except subprocess.CalledProcessError as e:
+                await context.bot.send_message(chat_id, f"❌ Вариант {i} не удался: {ffmpeg_error(e)}")
+                continue
+            except Exception as e:   # нет ffmpeg, кадр не того размера и т.п. — как в run_worker
+                await context.bot.send_message(chat_id, f"❌ Вариант {i} не удался: {str(e)[:300]}")
+                continue
 
-        # отправляем готовый файл
-        await context.bot.send_document(chat_id, open(out_file, 'rb'))
+        # отправляем готовые файлы (по одному на рендицию)
+        for o in job['outputs']:
+            await context.bot.send_document(chat_id, open(o['out'], 'rb'))
         await update_user_stat(chat_id, 'processed', 1)
+        delivered += 1
 
     # по окончании
+    await status.finish(f"✅ Отрендерено вариантов: {delivered}/{len(jobs)}")
     await context.bot.send_message(chat_id, '✅ Уникализация завершена.')
     await send_main_menu(chat_id, context)
     return CONFIGURING
@@ -719,6 +1649,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return CONFIGURING
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     query = update.callback_query
     await query.answer()
     stats = load_stats()
@@ -738,12 +1669,13 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     return CONFIGURING
 
 async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     uid = update.effective_chat.id
     if uid not in load_approved():
         await update.message.reply_text(
             "❌ Доступ забран администратором. Чтобы подать новую заявку, используйте /start"
         )
-        return ConversationHandler.END
+        return END
         
     query = update.callback_query
     await query.answer()
@@ -780,7 +1712,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     cid = update.effective_chat.id
     await context.bot.send_message(cid,'❌ Отмена.')
     await send_main_menu(cid,context)
-    return ConversationHandler.END
+    return END
 
 async def approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ожидаем команду вида /approve_123456789
@@ -796,13 +1728,104 @@ async def approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
-if __name__ == "__main__":
+# === Shared Conversation State ===
+INPUT_STATES = {
+    AWAITING_IMG_PROMPT, AWAITING_IMG_COUNT, UPLOADING_VIDEO,
+    UPLOADING_IMAGES, OFFSET_X_INPUT, OFFSET_Y_INPUT,
+}
+# callback_data, которые разбирает button_callback
+MENU_CALLBACK_PATTERN = (
+    r'^(toggle_img_gen|upload_video|upload_images|preview|start_process|settings|stats'
+    r'|set_off[xy]|admin_panel|back_main|(alpha|img|vid|fps|n)_(plus|minus)'
+    r'|aspect_(prev|next)|animate_toggle|quality_toggle|renditions_next)$'
+)
+
+def read_awaiting(chat_id: int):
+    # синхронно — вызывается из фильтров апдейтов
+    try:
+        return json.loads((SETTINGS_DIR / f"{chat_id}.json").read_text()).get('awaiting')
+    except (FileNotFoundError, ValueError):
+        return None
+
+def shared_state(handler):
+    # сохраняет шаг диалога в настройках чата, чтобы следующий апдейт
+    # мог обработать любой процесс, а не только тот, что видел предыдущий
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id
+        before  = (await load_chat_settings(chat_id))['awaiting']
+        state   = await handler(update, context)
+        s = await load_chat_settings(chat_id)
+        awaiting = state if state in INPUT_STATES else None
+        # не затираем шаг, который успел выставить параллельный апдейт
+        if s['awaiting'] == before and awaiting != before:
+            s['awaiting'] = awaiting
+            await save_chat_settings(chat_id, s)
+        return state
+    return wrapper
+
+# === Local Webhook Testing ===
+def fake_update(text: str = None, callback: str = None, chat_id: int = ADMIN_ID) -> dict:
+    # минимальный Update в формате Bot API: сообщение или нажатие кнопки
+    now = int(time.time())
+    chat = {"id": chat_id, "type": "private"}
+    user = {"id": chat_id, "is_bot": False, "first_name": "test"}
+    message = {"message_id": now, "date": now, "chat": chat, "from": user}
+    if callback is not None:
+        return {"update_id": now, "callback_query": {
+            "id": str(now), "from": user, "chat_instance": str(chat_id),
+            "message": message, "data": callback,
+        }}
+    message["text"] = text
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": now, "message": message}
+
+def send_fake_update(update: dict, url: str = None):
+    url  = url or f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+    resp = http_session().post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+    print(resp.status_code, resp.text)
+
+# === Startup Profile ===
+STARTUP_BUDGET_SEC = CONFIG["STARTUP_BUDGET_SEC"]
+
+def check_startup_budget(stage: str) -> float:
+    spent = time.perf_counter() - _T0
+    if spent > STARTUP_BUDGET_SEC:
+        print(f"⚠️ Старт ({stage}) занял {spent:.2f} с при бюджете {STARTUP_BUDGET_SEC} с, "
+              f"см. `python tg.py profile-imports`")
+    return spent
+
+def profile_imports(top: int = 15):
+    # -X importtime в чистом интерпретаторе: импорт модуля + сборка приложения
+    code = (f"import sys; sys.path.insert(0, {str(Path(__file__).resolve().parent)!r}); "
+            f"import tg; tg.build_app()")
+    # токен-заглушка: ApplicationBuilder не собирается с пустым токеном, а в сеть
+    # build_app не ходит
+    env  = dict(os.environ, BOT_TOKEN=BOT_TOKEN or "0:profile")
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True, env=env)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cum_us, name = line.split(':', 1)[1].split('|')
+        rows.append((int(cum_us), int(self_us), name.strip()))
+    if proc.returncode != 0:
+        print(proc.stderr.strip().splitlines()[-1])
+    total = sum(r[1] for r in rows) / 1e6
+    print(f"импорт: {total:.3f} с, бюджет старта: {STARTUP_BUDGET_SEC} с")
+    for cum_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cum_us / 1e3:9.1f} мс  {self_us / 1e3:8.1f} мс  {name}")
+
+# === Entry Point ===
+def build_app():
     from telegram.ext import (
         ApplicationBuilder,
-        ConversationHandler,
         CommandHandler,
         MessageHandler,
         CallbackQueryHandler,
+        ConversationHandler,
         filters,
     )
 
@@ -816,38 +1839,110 @@ if __name__ == "__main__":
         )
     )
 
+    class Awaiting(filters.MessageFilter):
+        # шаг диалога из общего хранилища, а не из памяти процесса
+        def __init__(self, state: int):
+            super().__init__(name=f"Awaiting({state})")
+            self.state = state
+
+        def filter(self, message) -> bool:
+            return read_awaiting(message.chat.id) == self.state
+
+    # шаги, где ждём ввод: (фильтр, обработчик)
+    inputs = {
+        AWAITING_IMG_PROMPT: (filters.TEXT & ~filters.COMMAND, generate_image_handler),
+        AWAITING_IMG_COUNT:  (filters.Regex(r'^[1-9]\d*$'), generate_image_with_count),
+        UPLOADING_VIDEO:     (filters.ALL, upload_video_handler),
+        UPLOADING_IMAGES:    (filters.ALL, upload_images_handler),
+        OFFSET_X_INPUT:      (filters.Regex(r'^-?\d+$'), offset_x_input),
+        OFFSET_Y_INPUT:      (filters.Regex(r'^-?\d+$'), offset_y_input),
+    }
+
     # ——— 2) ConversationHandler для всего остального
+    entry_points = [CommandHandler('start', shared_state(start))]
+    if BOT_MODE == 'webhook':
+        # апдейты одного чата приходят в разные реплики, а allow_reentry
+        # проверяет entry_points раньше состояний: здесь те же фильтры, что
+        # и в states, плюс шаг диалога из общего хранилища
+        entry_points += [
+            CallbackQueryHandler(shared_state(user_stats), pattern=r'^user_\d+$'),
+            CallbackQueryHandler(shared_state(button_callback), pattern=MENU_CALLBACK_PATTERN, block=False),
+            *(MessageHandler(flt & Awaiting(state), shared_state(handler))
+              for state, (flt, handler) in inputs.items()),
+        ]
+    if BOT_MODE == 'webhook':
+        # состояние в памяти реплики могло устареть (ввод обработала другая
+        # реплика), поэтому и здесь решает только общее хранилище
+        states = {state: [MessageHandler(flt & Awaiting(state), shared_state(handler))]
+                  for state, (flt, handler) in inputs.items()}
+    else:
+        states = {state: [MessageHandler(flt, handler)] for state, (flt, handler) in inputs.items()}
     conv = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=entry_points,
         states={
-            AWAITING_IMG_PROMPT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, generate_image_handler)
-            ],
-            AWAITING_IMG_COUNT: [
-                MessageHandler(filters.Regex(r'^[1-9]\d*$'), generate_image_with_count)
-            ],
-            UPLOADING_VIDEO: [
-                MessageHandler(filters.ALL, upload_video_handler)
-            ],
-            UPLOADING_IMAGES: [
-                MessageHandler(filters.ALL, upload_images_handler)
-            ],
-            OFFSET_X_INPUT: [
-                MessageHandler(filters.Regex(r'^-?\d+$'), offset_x_input)
-            ],
-            OFFSET_Y_INPUT: [
-                MessageHandler(filters.Regex(r'^-?\d+$'), offset_y_input)
-            ],
+            **states,
             CONFIGURING: [
                 # просмотр профиля пользователя в админке
                 CallbackQueryHandler(user_stats, pattern=r'^user_\d+$'),
                 # всё остальное меню (только button_callback):
-                CallbackQueryHandler(button_callback),
+                # не блокируем очередь апдейтов, пока идёт рендер
+                CallbackQueryHandler(button_callback, block=False),
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         allow_reentry=True,
     )
     app.add_handler(conv)
+    return app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tg.py")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("bot", help="запустить бота (по умолчанию)")
+    worker = sub.add_parser("worker", help="рендер-воркер: берёт задачи из очереди RENDER_DB")
+    worker.add_argument("--once", action="store_true", help="выйти, когда очередь опустеет")
+    fake = sub.add_parser("fake-update", help="отправить тестовый апдейт в локальный webhook")
+    fake.add_argument("text", nargs="?", default="/start")
+    fake.add_argument("--callback", help="callback_data вместо текста")
+    fake.add_argument("--chat-id", type=int, default=ADMIN_ID)
+    fake.add_argument("--url")
+    prof = sub.add_parser("profile-imports", help="показать самые дорогие импорты при старте")
+    prof.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    if args.command == "fake-update":
+        send_fake_update(fake_update(args.text, args.callback, args.chat_id), args.url)
+        return
+    if args.command == "profile-imports":
+        profile_imports(args.top)
+        return
+
+    if args.command != "worker" and missing_secrets():
+        sys.exit(f"Не заданы {', '.join(missing_secrets())}: "
+                 f"задайте в config.json (UNIK_CONFIG) или в переменных окружения")
 
-    app.run_polling()
+    ensure_storage()
+    if args.command == "worker":
+        check_startup_budget("worker")
+        run_worker(args.once)
+        return
+
+    app = build_app()
+    check_startup_budget("bot")
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            sys.exit("WEBHOOK_URL обязателен в режиме webhook")
+        if not WEBHOOK_SECRET:
+            sys.exit("WEBHOOK_SECRET обязателен в режиме webhook")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=WEBHOOK_URL.rstrip('/') + '/' + WEBHOOK_PATH,
+        )
+    else:
+        app.run_polling()
+
+if __name__ == "__main__":
+    main()